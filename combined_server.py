@@ -5,15 +5,298 @@ import threading
 import json
 import base64
 import hashlib
+import os
+import re
+import selectors
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
 
 # Configuration
 HTTP_PORT = 8000
 WS_PORT = 8765
+# How often blocking loops wake up to check for a pending reload
+POLL_INTERVAL = 0.5
+# How long a reload waits for sessions to finish their current frame
+DRAIN_TIMEOUT = 5.0
+# Environment variable carrying the handoff socket fd to the new process
+HANDOFF_FD_ENV = 'CHAT_HANDOFF_FD'
+# How long the old process waits for the new one to start accepting
+HANDOFF_ACK_TIMEOUT = 10.0
+# Linux refuses more than 253 fds in a single SCM_RIGHTS message
+MAX_FDS_PER_MSG = 250
+# Seconds between stack samples while profiling
+SAMPLE_INTERVAL = 0.005
+# Where collapsed-stack profiles are written (not the served directory)
+PROFILE_DIR = tempfile.gettempdir()
+# Prefix of the admin HTTP paths, only answered for local requests
+ADMIN_PATH = '/admin/profile'
+# Threads whose innermost frame is in these files are only waiting, not using CPU
+IDLE_FILES = {selectors.__file__, threading.__file__, socket.__file__}
+# Passes of the sampler between refreshes of the thread name cache
+THREAD_REFRESH_PASSES = 200
+# Environment variable naming a file to append inbound WebSocket traffic to
+CAPTURE_FILE_ENV = 'CHAT_CAPTURE_FILE'
+CAPTURE_MAGIC = b'WSCAP1\n'
+# Capture record header: wall-clock time, connection id, event kind, payload length
+CAPTURE_RECORD = struct.Struct('!dIBI')
+CAPTURE_OPEN, CAPTURE_FRAME, CAPTURE_CLOSE = 0, 1, 2
+# Seconds between flushes of buffered capture records
+CAPTURE_FLUSH_INTERVAL = 1.0
 
 # Store connected clients and their usernames
 ws_clients = {}
 # Store chat history
 chat_history = []
+# Client socket -> received bytes not yet forming a complete frame
+pending_data = {}
+
+# Set once a graceful reload has been requested (SIGHUP)
+reload_requested = threading.Event()
+# Every open WebSocket connection -> 'handshake', 'username' or 'joined'
+session_phases = {}
+# Guards joins, leaves and chat_history so a handoff snapshot is consistent
+state_lock = threading.Lock()
+# Connections that stopped reading so their sockets can be handed off
+parked_sessions = set()
+parked_cond = threading.Condition()
+
+# Traffic capture state, enabled by CHAT_CAPTURE_FILE
+capture_file = None
+capture_lock = threading.Lock()
+# Client socket -> capture connection id
+capture_ids = {}
+next_capture_id = 1
+
+# Profiling state, toggled by SIGUSR1 or the admin HTTP path
+profile_lock = threading.Lock()
+stage_timing = False
+# Stage name -> [count, total seconds, max seconds]
+stage_stats = {}
+# Collapsed stack -> number of samples, a fresh Counter per run
+stack_counts = Counter()
+sampler_stop = None
+sampler_thread = None
+# Set by the SIGUSR1 handler, acted on by the profile-toggle thread
+profile_toggle_requested = threading.Event()
+
+# Start timing a hot-path stage
+def stage_start():
+    """Return a start time, or None when stage timing is off"""
+    return time.perf_counter() if stage_timing else None
+
+# Finish timing a hot-path stage
+def stage_end(name, start):
+    """Record the time spent in a stage started with stage_start()"""
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    with profile_lock:
+        stats = stage_stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+# Label a thread so stacks of threads doing the same job merge
+def thread_root(thread):
+    """Return the name of a named thread, or the target of an auto-named one"""
+    # Auto names look like "Thread-12 (handle_ws_client)" or "Thread-12"
+    match = re.fullmatch(r'Thread-\d+(?: \((.+)\))?', thread.name)
+    if match is None:
+        return thread.name
+    return match.group(1) or 'Thread'
+
+# Sample the stacks of all other threads
+def sample_stacks(stop, counts):
+    """Count collapsed stacks of busy threads into counts until stop is set"""
+    me = threading.get_ident()
+    # Formatting every frame each pass is too slow with hundreds of threads
+    labels = {}
+    roots = {}
+    passes = 0
+    while not stop.wait(SAMPLE_INTERVAL):
+        passes += 1
+        if passes % THREAD_REFRESH_PASSES == 0:
+            # Thread idents are reused, so do not trust old names forever
+            roots.clear()
+        samples = []
+        for ident, frame in sys._current_frames().items():
+            # Threads parked in select(), accept() or wait() cost no CPU
+            if ident == me or frame.f_code.co_filename in IDLE_FILES:
+                continue
+            if ident not in roots:
+                roots.update((t.ident, thread_root(t)) for t in threading.enumerate())
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(roots.get(ident, str(ident)))
+            samples.append(';'.join(reversed(stack)))
+        with profile_lock:
+            counts.update(samples)
+
+# Start the sampler and stage timers
+def start_profiling():
+    """Turn profiling on, returns False if it was already running"""
+    global stage_timing, stack_counts, sampler_stop, sampler_thread
+    with profile_lock:
+        if sampler_stop is not None:
+            return False
+        stage_stats.clear()
+        # A new Counter, so a sampler still finishing its last pass cannot add to it
+        stack_counts = Counter()
+        stage_timing = True
+        sampler_stop = threading.Event()
+        sampler_thread = threading.Thread(
+            target=sample_stacks, args=(sampler_stop, stack_counts), name='profiler', daemon=True
+        )
+        thread = sampler_thread
+    thread.start()
+    print("Profiling started")
+    return True
+
+# Format per-stage timings as a table
+def format_stage_stats():
+    """Return per-stage timings as text"""
+    with profile_lock:
+        rows = sorted(stage_stats.items(), key=lambda item: item[1][1], reverse=True)
+    lines = [f"{'stage':<10} {'count':>8} {'total ms':>10} {'avg us':>9} {'max us':>9}"]
+    for name, (count, total, longest) in rows:
+        lines.append(f"{name:<10} {count:>8} {total * 1e3:>10.1f} {total / count * 1e6:>9.1f} {longest * 1e6:>9.1f}")
+    return '\n'.join(lines) + '\n'
+
+# Stop the sampler and write the collapsed stacks
+def stop_profiling():
+    """Turn profiling off and write a flamegraph file, returns its path"""
+    global stage_timing, sampler_stop, sampler_thread
+    with profile_lock:
+        if sampler_stop is None:
+            return None
+        stage_timing = False
+        sampler_stop.set()
+        sampler_stop = None
+        thread, counts = sampler_thread, stack_counts
+        sampler_thread = None
+    
+    # The sampler takes profile_lock, so wait for it outside the lock
+    thread.join()
+    with profile_lock:
+        collapsed = ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+    
+    # mkstemp picks an unpredictable name and never follows an existing symlink
+    fd, path = tempfile.mkstemp(prefix='chat-profile-', suffix='.folded', dir=PROFILE_DIR)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(collapsed)
+    print(f"Profiling stopped, stacks written to {path}")
+    print(format_stage_stats(), end='')
+    return path
+
+# Toggle profiling whenever a signal asks for it
+def watch_profile_toggle():
+    """Start profiling, or stop it if it is running, on each SIGUSR1"""
+    while True:
+        profile_toggle_requested.wait()
+        profile_toggle_requested.clear()
+        if stop_profiling() is None:
+            start_profiling()
+
+# Request a profiling toggle from a signal
+def toggle_profiling(signum, frame):
+    """Signal handler: only flag the toggle, the main thread may hold profile_lock"""
+    profile_toggle_requested.set()
+
+# Read the records of a capture file
+def read_capture_records(f):
+    """Yield (time, connection id, kind, payload bytes) after the magic header"""
+    while True:
+        header = f.read(CAPTURE_RECORD.size)
+        if len(header) < CAPTURE_RECORD.size:
+            return
+        timestamp, conn_id, kind, length = CAPTURE_RECORD.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            # Truncated last record, e.g. the server was killed mid-write
+            return
+        yield timestamp, conn_id, kind, payload
+
+# Find the highest connection id in a capture file
+def last_capture_id(f):
+    """Return the largest id after the magic header, seeking over payloads"""
+    last = 0
+    while True:
+        header = f.read(CAPTURE_RECORD.size)
+        if len(header) < CAPTURE_RECORD.size:
+            return last
+        _, conn_id, _, length = CAPTURE_RECORD.unpack(header)
+        last = max(last, conn_id)
+        f.seek(length, os.SEEK_CUR)
+
+# Open the capture file for appending
+def open_capture(path, resume_ids=True):
+    """Start recording inbound WebSocket traffic to path"""
+    global capture_file, next_capture_id
+    if resume_ids and os.path.exists(path):
+        # Continue after the ids of earlier runs appended to the same file
+        with open(path, 'rb') as f:
+            if f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC:
+                next_capture_id = last_capture_id(f) + 1
+    capture_file = open(path, 'ab')
+    if capture_file.tell() == 0:
+        capture_file.write(CAPTURE_MAGIC)
+        capture_file.flush()
+    threading.Thread(target=flush_capture_periodically, name='capture-flush', daemon=True).start()
+    print(f"Capturing WebSocket traffic to {path}")
+
+# Keep the capture file close to up to date
+def flush_capture_periodically():
+    """Flush buffered capture records every CAPTURE_FLUSH_INTERVAL seconds"""
+    while True:
+        time.sleep(CAPTURE_FLUSH_INTERVAL)
+        with capture_lock:
+            if capture_file is None:
+                return
+            capture_file.flush()
+
+# Flush and close the capture file
+def close_capture():
+    """Stop capturing, writing out any buffered records"""
+    global capture_file
+    with capture_lock:
+        if capture_file is not None:
+            capture_file.close()
+            capture_file = None
+
+# Give a client a capture connection id
+def assign_capture_id(client):
+    """Allocate the id a client's events are recorded under"""
+    global next_capture_id
+    with capture_lock:
+        capture_ids[client] = next_capture_id
+        next_capture_id += 1
+
+# Append one event to the capture file
+def capture_event(client, kind, payload=''):
+    """Record an open, frame or close event for a client"""
+    capture_id = capture_ids.get(client)
+    if capture_file is None or capture_id is None:
+        return
+    data = payload.encode('utf-8')
+    record = CAPTURE_RECORD.pack(time.time(), capture_id, kind, len(data)) + data
+    with capture_lock:
+        if capture_file is None:
+            return
+        capture_file.write(record)
+        if kind == CAPTURE_CLOSE:
+            # A finished session is written out straight away
+            capture_file.flush()
 
 # Send WebSocket message
 def send_ws_message(client, message):
@@ -29,18 +312,25 @@ def send_ws_message(client, message):
     else:
         frame = b'\x81\x7F' + length.to_bytes(8, 'big') + payload
     
+    start = stage_start()
     client.send(frame)
+    stage_end('send', start)
 
 # Broadcast message to all WebSocket clients
 def broadcast_message(message):
     """Broadcast message to all connected clients"""
+    fanout_start = stage_start()
     for client in list(ws_clients.keys()):
         try:
-            send_ws_message(client, json.dumps(message))
+            start = stage_start()
+            text = json.dumps(message)
+            stage_end('encode', start)
+            send_ws_message(client, text)
         except:
             # Remove disconnected client
             if client in ws_clients:
                 del ws_clients[client]
+    stage_end('fanout', fanout_start)
 
 # Handle WebSocket handshake
 def handle_handshake(client, data):
@@ -112,136 +402,538 @@ def decode_ws_frame(data):
         payload = data[payload_start:payload_start+length]
         return payload.decode('utf-8', errors='ignore')
 
+# Size of the frame at the start of a buffer
+def ws_frame_size(data):
+    """Return the total length of the first frame, None if its header is incomplete"""
+    if len(data) < 2:
+        return None
+    length = data[1] & 0x7F
+    header = 2
+    if length == 126:
+        header = 4
+    elif length == 127:
+        header = 10
+    if len(data) < header:
+        return None
+    if header > 2:
+        length = int.from_bytes(data[2:header], 'big')
+    if data[1] & 0x80:
+        header += 4
+    return header + length
+
+# Read the next complete frame from a client
+def next_ws_frame(client, selector):
+    """Return the next frame, b'' when the client closed, None if the session was parked"""
+    # Several frames can arrive in one recv(), or one frame across several
+    buffer = pending_data.pop(client, b'')
+    while True:
+        size = ws_frame_size(buffer)
+        if size is not None and len(buffer) >= size:
+            pending_data[client] = buffer[size:]
+            return buffer[:size]
+        if not wait_readable(client, selector):
+            pending_data[client] = buffer
+            return None
+        data = client.recv(4096)
+        if not data:
+            return b''
+        buffer += data
+
+# Park a session for the handoff
+def park_session(client):
+    """Record that a session stopped reading so its socket can be handed off"""
+    with parked_cond:
+        parked_sessions.add(client)
+        parked_cond.notify_all()
+
+# Wait for data unless a reload wants the session parked
+def wait_readable(client, selector):
+    """Return True once client has data, False if the session was parked"""
+    # A selector rather than select() so fds above 1024 work
+    while not reload_requested.is_set():
+        if selector.select(POLL_INTERVAL):
+            return True
+    # Stop reading so no frame is lost between the two processes
+    park_session(client)
+    return False
+
 # Handle WebSocket client connection
-def handle_ws_client(client, addr):
-    """Handle a WebSocket client connection"""
+def handle_ws_client(client, addr, phase='handshake'):
+    """Handle a WebSocket client connection from the given phase onwards"""
     username = None
+    # Set when a reload parks the session; the socket then belongs to someone else
+    parked = False
+    selector = selectors.DefaultSelector()
+    selector.register(client, selectors.EVENT_READ)
     
     try:
-        # Receive handshake
-        data = client.recv(4096)
-        if not handle_handshake(client, data):
-            client.close()
-            return
+        if phase == 'handshake':
+            # Receive handshake
+            if not wait_readable(client, selector):
+                parked = True
+                return
+            data = client.recv(4096)
+            start = stage_start()
+            shaken = handle_handshake(client, data)
+            stage_end('handshake', start)
+            if not shaken:
+                client.close()
+                return
+            assign_capture_id(client)
+            capture_event(client, CAPTURE_OPEN)
+            session_phases[client] = 'username'
         
         # Receive username
         while True:
-            data = client.recv(1024)
+            data = next_ws_frame(client, selector)
+            if data is None:
+                parked = True
+                return
             if not data:
                 break
             
             message = decode_ws_frame(data)
             if message:
+                capture_event(client, CAPTURE_FRAME, message)
                 username = message.strip()
-                ws_clients[client] = username
                 break
         
         if username:
-            # Send chat history
-            for msg in chat_history:
-                send_ws_message(client, json.dumps(msg))
-            
-            # Broadcast user joined
             join_msg = {
                 'type': 'user-joined',
                 'username': username,
                 'message': f"{username} 加入了聊天室！"
             }
-            chat_history.append(join_msg)
+            with state_lock:
+                ws_clients[client] = username
+                session_phases[client] = 'joined'
+                history = list(chat_history)
+                chat_history.append(join_msg)
+                users = list(ws_clients.values())
+            
+            # Send chat history
+            for msg in history:
+                send_ws_message(client, json.dumps(msg))
+            
+            # Broadcast user joined
             broadcast_message(join_msg)
             
             # Broadcast user list
             user_list_msg = {
                 'type': 'user-list',
-                'users': list(ws_clients.values())
+                'users': users
             }
             broadcast_message(user_list_msg)
             
-            # Handle messages
-            while True:
-                data = client.recv(1024)
-                if not data:
-                    break
-                
-                message = decode_ws_frame(data)
-                if message:
-                    try:
-                        msg = json.loads(message)
-                        if msg['type'] == 'chat':
-                            chat_msg = {
-                                'type': 'chat',
-                                'username': username,
-                                'message': msg['message'],
-                                'timestamp': msg['timestamp']
-                            }
-                            chat_history.append(chat_msg)
-                            broadcast_message(chat_msg)
-                    except:
-                        pass
+            parked = serve_ws_session(client, username, selector)
     
     finally:
-        # Clean up
-        if client in ws_clients:
+        selector.close()
+        if not parked:
+            remove_ws_client(client, username)
+
+# Read chat messages from a joined client
+def serve_ws_session(client, username, selector):
+    """Handle chat frames until the client leaves, returns True if a reload parked it"""
+    while True:
+        data = next_ws_frame(client, selector)
+        if data is None:
+            return True
+        if not data:
+            return False
+        
+        start = stage_start()
+        message = decode_ws_frame(data)
+        stage_end('decode', start)
+        if message:
+            capture_event(client, CAPTURE_FRAME, message)
+            try:
+                start = stage_start()
+                msg = json.loads(message)
+                stage_end('parse', start)
+                if msg['type'] == 'chat':
+                    chat_msg = {
+                        'type': 'chat',
+                        'username': username,
+                        'message': msg['message'],
+                        'timestamp': msg['timestamp']
+                    }
+                    with state_lock:
+                        chat_history.append(chat_msg)
+                    broadcast_message(chat_msg)
+            except:
+                pass
+
+# Remove a WebSocket client and tell everyone it left
+def remove_ws_client(client, username):
+    """Clean up a disconnected WebSocket client"""
+    capture_event(client, CAPTURE_CLOSE)
+    capture_ids.pop(client, None)
+    session_phases.pop(client, None)
+    pending_data.pop(client, None)
+    if client in ws_clients:
+        leave_msg = {
+            'type': 'user-left',
+            'username': username,
+            'message': f"{username} 离开了聊天室！"
+        }
+        with state_lock:
+            # broadcast_message may already have dropped it
+            ws_clients.pop(client, None)
+            users = list(ws_clients.values())
             if username:
-                # Broadcast user left
-                leave_msg = {
-                    'type': 'user-left',
-                    'username': username,
-                    'message': f"{username} 离开了聊天室！"
-                }
                 chat_history.append(leave_msg)
-                broadcast_message(leave_msg)
-                
-                # Broadcast updated user list
-                user_list_msg = {
-                    'type': 'user-list',
-                    'users': [v for k, v in ws_clients.items() if k != client]
-                }
-                broadcast_message(user_list_msg)
-            
-            del ws_clients[client]
         
-        try:
-            client.close()
-        except:
-            pass
+        if username:
+            # Broadcast user left
+            broadcast_message(leave_msg)
+            
+            # Broadcast updated user list
+            user_list_msg = {
+                'type': 'user-list',
+                'users': users
+            }
+            broadcast_message(user_list_msg)
+    
+    try:
+        client.close()
+    except:
+        pass
+
+# Handle a joined WebSocket session inherited from the previous process
+def handle_adopted_client(client, username):
+    """Resume an already joined WebSocket client after a reload"""
+    parked = False
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(client, selectors.EVENT_READ)
+            parked = serve_ws_session(client, username, selector)
+    except OSError:
+        pass
+    finally:
+        if not parked:
+            remove_ws_client(client, username)
+
+# Restart a parked or inherited connection in its phase
+def resume_session(client, phase, username):
+    """Start a handler thread that picks the connection up where it stopped"""
+    session_phases[client] = phase
+    if phase == 'joined':
+        ws_clients[client] = username
+        target, args = handle_adopted_client, (client, username)
+    else:
+        target, args = handle_ws_client, (client, None, phase)
+    threading.Thread(target=target, args=args, daemon=True).start()
 
 # Start WebSocket server
-def start_ws_server():
-    """Start the WebSocket server"""
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind(('0.0.0.0', WS_PORT))
-    server.listen(5)
+def start_ws_server(server=None):
+    """Start the WebSocket server, optionally on an inherited listening socket"""
+    if server is None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('0.0.0.0', WS_PORT))
+        server.listen(5)
+    # Wake up periodically so a reload can stop accepting
+    server.settimeout(POLL_INTERVAL)
     
     print(f"WebSocket server started on ws://0.0.0.0:{WS_PORT}")
     
-    try:
-        while True:
+    while not reload_requested.is_set():
+        try:
             client, addr = server.accept()
-            print(f"New WebSocket connection from {addr}")
-            threading.Thread(target=handle_ws_client, args=(client, addr), daemon=True).start()
-    except KeyboardInterrupt:
-        print("WebSocket server shutting down...")
-    finally:
-        server.close()
+        except socket.timeout:
+            continue
+        print(f"New WebSocket connection from {addr}")
+        session_phases[client] = 'handshake'
+        threading.Thread(target=handle_ws_client, args=(client, addr), daemon=True).start()
+    
+    # The listening socket is left open for the handoff
+    return server
+
+# Serve static files plus the local profiling admin paths
+class AdminHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler that also answers /admin/profile/{start,stop,stats}"""
+    
+    def do_GET(self):
+        if not self.path.startswith(ADMIN_PATH + '/'):
+            return super().do_GET()
+        if self.client_address[0] not in ('127.0.0.1', '::1'):
+            return self.send_error(403)
+        
+        action = self.path[len(ADMIN_PATH) + 1:]
+        if action == 'start':
+            body = "Profiling started\n" if start_profiling() else "Profiling already running\n"
+        elif action == 'stop':
+            path = stop_profiling()
+            body = f"Stacks written to {path}\n" + format_stage_stats() if path else "Profiling not running\n"
+        elif action == 'stats':
+            body = format_stage_stats()
+        else:
+            return self.send_error(404)
+        
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+# Create the HTTP server
+def create_http_server(sock=None):
+    """Create the HTTP server, optionally on an inherited listening socket"""
+    Handler = AdminHTTPRequestHandler
+    
+    if sock is None:
+        return socketserver.TCPServer(('0.0.0.0', HTTP_PORT), Handler)
+    
+    httpd = socketserver.TCPServer(('0.0.0.0', HTTP_PORT), Handler, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = sock
+    return httpd
 
 # Start HTTP server
-def start_http_server():
-    """Start the HTTP server"""
-    Handler = http.server.SimpleHTTPRequestHandler
+def start_http_server(httpd):
+    """Serve HTTP until interrupted or a reload is requested"""
+    print(f"HTTP server started on http://0.0.0.0:{HTTP_PORT}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("HTTP server shutting down...")
+        httpd.server_close()
+
+# Request a graceful reload
+def request_reload(httpd):
+    """Signal handler: stop accepting and hand everything to a new process"""
+    if reload_requested.is_set():
+        return
+    print("Reload requested, handing off to a new process...")
+    reload_requested.set()
+    # shutdown() blocks until serve_forever returns, so it cannot run here
+    threading.Thread(target=httpd.shutdown, daemon=True).start()
+
+# Read a fixed-size chunk from the handoff socket
+def recv_exact(sock, n):
+    """Receive exactly n bytes from a stream socket"""
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("handoff socket closed early")
+        data += chunk
+    return data
+
+# Hand listening sockets, sessions and state to a new process
+def hand_off(http_sock, ws_sock):
+    """Start a new server process and pass it our sockets over SCM_RIGHTS"""
+    # Let every connection finish the frame it is handling, then stop reading
+    with parked_cond:
+        parked_cond.wait_for(
+            lambda: all(c in parked_sessions for c in list(session_phases)),
+            timeout=DRAIN_TIMEOUT
+        )
     
-    with socketserver.TCPServer(('0.0.0.0', HTTP_PORT), Handler) as httpd:
-        print(f"HTTP server started on http://0.0.0.0:{HTTP_PORT}")
+    # Hold off joins, leaves and chat history until we exit or resume
+    state_lock.acquire()
+    handed_off = False
+    try:
+        # A joined session that broadcast_message dropped has nobody to hand off
+        sessions = [
+            (c, session_phases.get(c)) for c in list(session_phases)
+            if c in parked_sessions and (session_phases.get(c) != 'joined' or c in ws_clients)
+        ]
+        dropped = len(session_phases) - len(sessions)
+        if dropped:
+            # Their old thread may still be using the socket, so they are not passed on
+            print(f"{dropped} connection(s) did not stop in time and will be dropped")
+        handed = {c for c, _ in sessions}
+        dropped_users = [
+            username for c, username in list(ws_clients.items())
+            if c not in handed and username
+        ]
+        
+        state = json.dumps({
+            'history': chat_history,
+            'sessions': [
+                {
+                    'phase': phase,
+                    'username': ws_clients.get(c),
+                    'capture_id': capture_ids.get(c),
+                    # Part of a frame the old process already read
+                    'pending': base64.b64encode(pending_data.get(c, b'')).decode()
+                }
+                for c, phase in sessions
+            ],
+            'next_capture_id': next_capture_id,
+            # Joined users that are not coming along, announced as left by the new process
+            'dropped_users': dropped_users
+        }).encode('utf-8')
+        fds = [http_sock.fileno(), ws_sock.fileno()] + [c.fileno() for c, _ in sessions]
+        
+        # The new process appends to the same file
+        with capture_lock:
+            if capture_file is not None:
+                capture_file.flush()
+        
+        parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        env = dict(os.environ, **{HANDOFF_FD_ENV: str(child.fileno())})
         try:
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("HTTP server shutting down...")
+            process = subprocess.Popen([sys.executable] + sys.argv, env=env, pass_fds=[child.fileno()])
+        except OSError as e:
+            print(f"Could not start new process: {e}")
+            parent.close()
+            return False
+        finally:
+            child.close()
+        
+        # A hung new process must not stall us with accept and HTTP stopped
+        parent.settimeout(HANDOFF_ACK_TIMEOUT)
+        try:
+            # Header: state length and fd count, then fds one batch per byte, then state
+            parent.sendall(struct.pack('!II', len(state), len(fds)))
+            for i in range(0, len(fds), MAX_FDS_PER_MSG):
+                socket.send_fds(parent, [b'\x00'], fds[i:i + MAX_FDS_PER_MSG])
+            parent.sendall(state)
+            
+            # Wait until the new process is accepting before going away
+            ack = parent.recv(2)
+        except OSError:
+            ack = b''
+        parent.close()
+        if ack != b'ok':
+            # Make sure a hung new process does not keep serving our sockets
+            process.kill()
+            process.wait()
+            print("New process did not take over, resuming service")
+            return False
+        print(f"Handed off {len(sessions)} WebSocket connection(s), exiting")
+        handed_off = True
+        return True
+    finally:
+        # On success the lock stays held until the process exits
+        if not handed_off:
+            state_lock.release()
+
+# Receive sockets and state from the previous process
+def receive_handoff(fd):
+    """Adopt listening sockets, sessions and chat history from the old process"""
+    global next_capture_id
+    conn = socket.socket(fileno=fd)
+    state_len, fd_count = struct.unpack('!II', recv_exact(conn, 8))
+    fds = []
+    while len(fds) < fd_count:
+        _, batch, _, _ = socket.recv_fds(conn, 1, min(MAX_FDS_PER_MSG, fd_count - len(fds)))
+        fds.extend(batch)
+    state = json.loads(recv_exact(conn, state_len).decode('utf-8'))
+    
+    http_sock = socket.socket(fileno=fds[0])
+    ws_sock = socket.socket(fileno=fds[1])
+    chat_history.extend(state['history'])
+    next_capture_id = state['next_capture_id']
+    
+    for fd, session in zip(fds[2:], state['sessions']):
+        client = socket.socket(fileno=fd)
+        client.setblocking(True)
+        if session['capture_id'] is not None:
+            capture_ids[client] = session['capture_id']
+        if session['pending']:
+            pending_data[client] = base64.b64decode(session['pending'])
+        resume_session(client, session['phase'], session['username'])
+    
+    print(f"Took over {len(state['sessions'])} WebSocket connection(s) from previous process")
+    announce_dropped_users(state['dropped_users'])
+    return conn, http_sock, ws_sock
+
+# Tell everyone about users the previous process could not hand off
+def announce_dropped_users(usernames):
+    """Broadcast a leave for each dropped user and the corrected user list"""
+    if not usernames:
+        return
+    leave_msgs = [
+        {
+            'type': 'user-left',
+            'username': username,
+            'message': f"{username} 离开了聊天室！"
+        }
+        for username in usernames
+    ]
+    with state_lock:
+        chat_history.extend(leave_msgs)
+        users = list(ws_clients.values())
+    
+    for leave_msg in leave_msgs:
+        broadcast_message(leave_msg)
+    
+    user_list_msg = {
+        'type': 'user-list',
+        'users': users
+    }
+    broadcast_message(user_list_msg)
+
+# Go back to serving after a failed handoff
+def resume_after_failed_handoff(ws_server):
+    """Clear the reload and restart accepting and the parked sessions"""
+    reload_requested.clear()
+    with parked_cond:
+        resumed = list(parked_sessions)
+        parked_sessions.clear()
+    for client in resumed:
+        phase = session_phases.get(client)
+        if phase == 'joined' and client not in ws_clients:
+            remove_ws_client(client, None)
+        elif phase is not None:
+            resume_session(client, phase, ws_clients.get(client))
+    
+    ws_thread = threading.Thread(target=start_ws_server, args=(ws_server,), daemon=True)
+    ws_thread.start()
+    return ws_thread
 
 if __name__ == "__main__":
+    if os.environ.get(CAPTURE_FILE_ENV):
+        # On a reload the handoff state carries next_capture_id, and scanning
+        # a large file here would eat into the old process's ack timeout
+        open_capture(os.environ[CAPTURE_FILE_ENV], resume_ids=HANDOFF_FD_ENV not in os.environ)
+    
+    handoff_conn = None
+    http_sock = ws_sock = None
+    if HANDOFF_FD_ENV in os.environ:
+        handoff_conn, http_sock, ws_sock = receive_handoff(int(os.environ.pop(HANDOFF_FD_ENV)))
+    
+    httpd = create_http_server(http_sock)
+    ws_result = {}
+    
     # Start WebSocket server in a thread
-    ws_thread = threading.Thread(target=start_ws_server, daemon=True)
+    ws_thread = threading.Thread(
+        target=lambda: ws_result.update(server=start_ws_server(ws_sock)),
+        daemon=True
+    )
     ws_thread.start()
     
+    # Graceful reload on SIGHUP (Unix only)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: request_reload(httpd))
+    # Toggle the sampling profiler on SIGUSR1 (Unix only)
+    if hasattr(signal, 'SIGUSR1'):
+        threading.Thread(target=watch_profile_toggle, name='profile-toggle', daemon=True).start()
+        signal.signal(signal.SIGUSR1, toggle_profiling)
+    # Leave through the cleanup below on SIGTERM too, like on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    if handoff_conn is not None:
+        # Tell the old process we are accepting so it can exit
+        handoff_conn.sendall(b'ok')
+        handoff_conn.close()
+    
     # Start HTTP server in main thread
-    start_http_server()
\ No newline at end of file
+    try:
+        while True:
+            start_http_server(httpd)
+            if not reload_requested.is_set():
+                break
+            
+            ws_thread.join()
+            if hand_off(httpd.socket, ws_result['server']):
+                # Skip interpreter teardown so no socket is shut down on exit
+                os._exit(0)
+            ws_thread = resume_after_failed_handoff(ws_result['server'])
+    finally:
+        close_capture()
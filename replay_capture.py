@@ -0,0 +1,359 @@
+import argparse
+import base64
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from combined_server import (
+    CAPTURE_MAGIC, CAPTURE_OPEN, CAPTURE_FRAME, CAPTURE_CLOSE, WS_PORT, read_capture_records
+)
+
+# How long to wait for outstanding echoes before a close or after the last event
+DRAIN_TIMEOUT = 2.0
+# How long to wait for the server to confirm a join
+JOIN_TIMEOUT = 2.0
+
+# Read a capture file written by combined_server.py
+def read_capture(path):
+    """Return the captured events as (time, connection id, kind, text) tuples"""
+    events = []
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a WebSocket capture file")
+        for timestamp, conn_id, kind, payload in read_capture_records(f):
+            events.append((timestamp, conn_id, kind, payload.decode('utf-8')))
+    events.sort(key=lambda event: event[0])
+    return events
+
+# Build a masked client-to-server text frame
+def encode_client_frame(text):
+    """Encode a WebSocket text frame the way a browser would"""
+    payload = text.encode('utf-8')
+    length = len(payload)
+
+    if length <= 125:
+        header = b'\x81' + (0x80 | length).to_bytes(1, 'big')
+    elif length <= 65535:
+        header = b'\x81\xFE' + length.to_bytes(2, 'big')
+    else:
+        header = b'\x81\xFF' + length.to_bytes(8, 'big')
+
+    mask = os.urandom(4)
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return header + mask + masked
+
+# Return a percentile of a sorted list
+def percentile(values, pct):
+    """Nearest-rank percentile, None for an empty list"""
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+# One replayed WebSocket session
+class ReplayConnection:
+    """Client connection that sends captured frames and times the echoes"""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((
+            'GET / HTTP/1.1\r\n'
+            f'Host: {host}:{port}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {key}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            '\r\n'
+        ).encode())
+        response = b''
+        while b'\r\n\r\n' not in response:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("server closed the connection during the handshake")
+            response += chunk
+        if not response.startswith(b'HTTP/1.1 101'):
+            raise ConnectionError("server refused the WebSocket handshake")
+
+        self.username = None
+        # Set once the server has sent the user list that follows our join
+        self.joined = threading.Event()
+        self.lock = threading.Condition()
+        # (message, timestamp) -> send times of chat messages awaiting their echo
+        self.pending = {}
+        self.latencies = []
+        self.chats_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.last_received = None
+        self.buffer = response.split(b'\r\n\r\n', 1)[1]
+        self.reader = threading.Thread(target=self.read_frames, daemon=True)
+        self.reader.start()
+
+    def send(self, text):
+        """Send one captured frame, remembering when chat messages went out"""
+        if self.username is None:
+            self.username = text.strip()
+            self.sock.sendall(encode_client_frame(text))
+            # Like a browser, only send chat once the join went through
+            self.joined.wait(JOIN_TIMEOUT)
+            return
+
+        try:
+            msg = json.loads(text)
+            if msg.get('type') == 'chat':
+                key = (msg.get('message'), msg.get('timestamp'))
+                with self.lock:
+                    self.pending.setdefault(key, deque()).append(time.perf_counter())
+                    self.chats_sent += 1
+        except (ValueError, AttributeError):
+            pass
+        self.sock.sendall(encode_client_frame(text))
+
+    def read_frames(self):
+        """Read server frames until the connection closes"""
+        try:
+            while True:
+                frame = self.next_frame()
+                if frame is None:
+                    break
+                received = time.perf_counter()
+                self.last_received = received
+                self.frames_received += 1
+                self.bytes_received += len(frame)
+                self.match_echo(frame, received)
+        except OSError:
+            pass
+        finally:
+            # Wake wait_for_echoes(), nothing more will come back
+            with self.lock:
+                self.lock.notify_all()
+
+    def next_frame(self):
+        """Return the next unmasked payload from the server, None at EOF"""
+        while True:
+            if len(self.buffer) >= 2:
+                length = self.buffer[1] & 0x7F
+                start = 2
+                if length == 126:
+                    start = 4
+                elif length == 127:
+                    start = 10
+                if len(self.buffer) >= start:
+                    if start > 2:
+                        length = int.from_bytes(self.buffer[2:start], 'big')
+                    if len(self.buffer) >= start + length:
+                        payload = self.buffer[start:start + length]
+                        self.buffer = self.buffer[start + length:]
+                        return payload
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return None
+            self.buffer += chunk
+
+    def match_echo(self, frame, received):
+        """Record the latency when our own chat message comes back"""
+        try:
+            msg = json.loads(frame.decode('utf-8'))
+        except ValueError:
+            return
+        if msg.get('type') == 'user-list':
+            self.joined.set()
+        if msg.get('type') != 'chat' or msg.get('username') != self.username:
+            return
+        key = (msg.get('message'), msg.get('timestamp'))
+        with self.lock:
+            sent = self.pending.get(key)
+            if sent:
+                self.latencies.append(received - sent.popleft())
+                self.lock.notify_all()
+
+    def outstanding(self):
+        """Number of chat messages still waiting for their echo"""
+        with self.lock:
+            return sum(len(sent) for sent in self.pending.values())
+
+    def wait_for_echoes(self, timeout):
+        """Wait until every chat message sent has come back, or timeout"""
+        with self.lock:
+            self.lock.wait_for(
+                lambda: not any(self.pending.values()) or not self.reader.is_alive(),
+                timeout=timeout
+            )
+
+    def close(self):
+        """Close the connection, the server then broadcasts the leave"""
+        try:
+            # close() alone sends no FIN while the reader is blocked in recv()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.join()
+        self.sock.close()
+
+# Replay captured events against a server
+def replay(events, host, port, speed):
+    """Replay events at speed (None for as fast as possible) and return a report"""
+    connections = {}
+    finished = []
+    lags = []
+    frames_sent = 0
+    failed = 0
+
+    first = events[0][0]
+    started = time.perf_counter()
+    for timestamp, conn_id, kind, text in events:
+        if speed is not None:
+            due = started + (timestamp - first) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lags.append(max(0.0, time.perf_counter() - due))
+
+        try:
+            if kind == CAPTURE_OPEN:
+                if conn_id in connections:
+                    # An id reused by an older capture, finish that session first
+                    conn = connections.pop(conn_id)
+                    conn.wait_for_echoes(DRAIN_TIMEOUT)
+                    conn.close()
+                    finished.append(conn)
+                connections[conn_id] = ReplayConnection(host, port)
+            elif kind == CAPTURE_FRAME and conn_id in connections:
+                connections[conn_id].send(text)
+                frames_sent += 1
+            elif kind == CAPTURE_CLOSE and conn_id in connections:
+                conn = connections.pop(conn_id)
+                # Do not count echoes still in flight as lost
+                conn.wait_for_echoes(DRAIN_TIMEOUT)
+                conn.close()
+                finished.append(conn)
+        except OSError:
+            failed += 1
+            conn = connections.pop(conn_id, None)
+            if conn is not None:
+                finished.append(conn)
+    sent_done = time.perf_counter()
+
+    # Give the server a moment to echo what is still in flight
+    deadline = sent_done + DRAIN_TIMEOUT
+    while time.perf_counter() < deadline and any(c.outstanding() for c in connections.values()):
+        time.sleep(0.01)
+    for conn in connections.values():
+        conn.close()
+        finished.append(conn)
+
+    latencies = sorted(l for conn in finished for l in conn.latencies)
+    lags.sort()
+    captured_duration = events[-1][0] - first
+    captured_frames = sum(1 for event in events if event[2] == CAPTURE_FRAME)
+    replay_duration = sent_done - started
+    frames_received = sum(conn.frames_received for conn in finished)
+    chats_sent = sum(conn.chats_sent for conn in finished)
+    # Frames keep arriving after the last send, so count up to the last one received
+    last_received = max((c.last_received for c in finished if c.last_received), default=None)
+    receive_duration = last_received - started if last_received else None
+
+    return {
+        'speed': speed,
+        'connections': sum(1 for event in events if event[2] == CAPTURE_OPEN),
+        'failed': failed,
+        'captured_duration_s': captured_duration,
+        'captured_frames_per_s': captured_frames / captured_duration if captured_duration else None,
+        'replay_duration_s': replay_duration,
+        'target_duration_s': captured_duration / speed if speed else None,
+        'frames_sent': frames_sent,
+        'frames_sent_per_s': frames_sent / replay_duration if replay_duration else None,
+        'frames_received': frames_received,
+        'frames_received_per_s': frames_received / receive_duration if receive_duration else None,
+        'chats_sent': chats_sent,
+        'echoes': len(latencies),
+        # Chat messages the server never sent back, e.g. merged into one recv()
+        'echoes_lost': chats_sent - len(latencies),
+        'latency_ms': {
+            name: percentile(latencies, pct) * 1e3 if latencies else None
+            for name, pct in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100))
+        },
+        'schedule_lag_ms': {
+            name: percentile(lags, pct) * 1e3 if lags else None
+            for name, pct in (('p50', 50), ('p99', 99), ('max', 100))
+        },
+    }
+
+# Format a number that may be missing
+def fmt(value, digits=1):
+    """Format a float, or a dash when it is None"""
+    return '-' if value is None else f"{value:.{digits}f}"
+
+# Print a report, with differences against a baseline report if given
+def print_report(report, baseline=None):
+    """Print the replay report in a readable form"""
+    speed = 'max' if report['speed'] is None else f"{report['speed']:g}x"
+    print(f"Replayed {report['connections']} connection(s) at {speed} "
+          f"({report['failed']} failed)")
+    print(f"  captured: {fmt(report['captured_duration_s'], 2)} s, "
+          f"{fmt(report['captured_frames_per_s'])} frames/s inbound")
+    print(f"  replay:   {fmt(report['replay_duration_s'], 2)} s "
+          f"(target {fmt(report['target_duration_s'], 2)} s), "
+          f"lag p50/p99/max {fmt(report['schedule_lag_ms']['p50'], 2)}/"
+          f"{fmt(report['schedule_lag_ms']['p99'], 2)}/{fmt(report['schedule_lag_ms']['max'], 2)} ms")
+
+    # (label, key, digits); latency keys are looked up in 'latency_ms'
+    metrics = [
+        ('sent frames/s', 'frames_sent_per_s', 2),
+        ('received frames/s', 'frames_received_per_s', 2),
+        ('chat messages sent', 'chats_sent', 0),
+        ('echoes received', 'echoes', 0),
+        ('echoes lost', 'echoes_lost', 0),
+    ]
+    rows = [
+        (label, report.get(key), baseline.get(key) if baseline else None, digits)
+        for label, key, digits in metrics
+    ]
+    for name in ('p50', 'p95', 'p99', 'max'):
+        rows.append((f"echo latency {name} ms", report['latency_ms'][name],
+                     baseline['latency_ms'][name] if baseline else None, 2))
+
+    print(f"  {'metric':<22} {'value':>10}" + (f" {'baseline':>10} {'change':>8}" if baseline else ''))
+    for name, value, before, digits in rows:
+        line = f"  {name:<22} {fmt(value, digits):>10}"
+        if baseline:
+            change = f"{(value - before) / before * 100:+.1f}%" if value is not None and before else '-'
+            line += f" {fmt(before, digits):>10} {change:>8}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a captured WebSocket session file")
+    parser.add_argument('capture', help="file written with CHAT_CAPTURE_FILE set")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=WS_PORT)
+    parser.add_argument('--speed', default='1',
+                        help="time scale, e.g. 1 or 10, or 'max' for no delays (default 1)")
+    parser.add_argument('--json', metavar='PATH', help="also write the report as JSON")
+    parser.add_argument('--baseline', metavar='PATH', help="JSON report of an earlier run to compare with")
+    args = parser.parse_args()
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    if speed is not None and speed <= 0:
+        parser.error("--speed must be positive or 'max'")
+
+    events = read_capture(args.capture)
+    if not events:
+        parser.error(f"{args.capture} contains no events")
+
+    report = replay(events, args.host, args.port, speed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()